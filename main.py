@@ -1,10 +1,16 @@
 import os
-import glob
 import time
 import logging
-import requests
-import json
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+import logging.handlers
+import queue
+import threading
+import asyncio
+import sqlite3
+import hashlib
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
@@ -16,17 +22,17 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-MENDELEY_CLIENT_ID = os.getenv("MENDELEY_CLIENT_ID")
-MENDELEY_CLIENT_SECRET = os.getenv("MENDELEY_CLIENT_SECRET")
-MENDELEY_REFRESH_TOKEN = os.getenv("MENDELEY_REFRESH_TOKEN")
-MENDELEY_REDIRECT_URI = os.getenv("MENDELEY_REDIRECT_URI", "http://localhost:8585/callback")
-
-if not all([MENDELEY_CLIENT_ID, MENDELEY_CLIENT_SECRET, MENDELEY_REFRESH_TOKEN]):
+if not all(os.getenv(name) for name in ("MENDELEY_CLIENT_ID", "MENDELEY_CLIENT_SECRET", "MENDELEY_REFRESH_TOKEN")):
     print("WARNING: Missing credentials in .env file.")
 
-TOKEN_URL = "https://api.mendeley.com/oauth/token"
-DOCUMENTS_URL = "https://api.mendeley.com/documents"
-FILES_URL = "https://api.mendeley.com/files"
+# Larger files are skipped rather than sent only to be rejected (default 100 MB)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+
+# Records files already uploaded so re-runs skip them
+MANIFEST_DB = os.getenv("MANIFEST_DB", "uploads.db")
+
+# Filename characters shown as spaces in document titles
+_TITLE_TRANS = str.maketrans({'_': ' '})
 
 # --- Logging Setup ---
 LOG_FILE = "mendeley_uploader.log"
@@ -35,147 +41,276 @@ class MemoryHandler(logging.Handler):
     def __init__(self, capacity=1000):
         super().__init__()
         self.capacity = capacity
-        self.logs = []
+        self.logs = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.logs.append(self.format(record))
+
+class _BufferedFileHandler(logging.FileHandler):
+    """FileHandler writing through a 64 KiB buffer instead of flushing every record.
+
+    The buffer is written out on errors and on records logged with
+    `extra=FLUSH_LOG`, so the file is current at the end of each batch.
+    """
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=1 << 16, encoding=self.encoding)
 
     def emit(self, record):
-        log_entry = self.format(record)
-        self.logs.append(log_entry)
-        if len(self.logs) > self.capacity:
-            self.logs.pop(0)
+        super().emit(record)
+        if self.stream and (record.levelno >= logging.ERROR or getattr(record, 'flush_log', False)):
+            self.stream.flush()
+
+    def flush(self):
+        pass
+
+FLUSH_LOG = {'flush_log': True}
 
 # Create loggers
 logger = logging.getLogger("mendeley_uploader")
 logger.setLevel(logging.INFO)
 
-# File handler
-file_handler = logging.FileHandler(LOG_FILE, mode='w')
+# File handler: opened on the first record, block-buffered, flushed when closed at exit
+file_handler = _BufferedFileHandler(LOG_FILE, mode='w', delay=True)
 file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
 
 # Memory handler for UI
 memory_handler = MemoryHandler()
 memory_formatter = logging.Formatter('%(levelname)s: %(message)s')
 memory_handler.setFormatter(memory_formatter)
-logger.addHandler(memory_handler)
 
 # Console handler
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(memory_formatter)
-logger.addHandler(console_handler)
+
+# Workers only enqueue records; a listener thread does the actual I/O
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, memory_handler, console_handler)
+log_listener.start()
 
 # --- State ---
 class UploadState:
-    is_running = False
-    total_files = 0
-    processed_files = 0
-    current_file = ""
-    status_message = "Idle"
-    should_stop = False
+    """Upload progress shared between worker threads and the API; mutate under `lock`."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.is_running = False
+        self.total_files = 0
+        self.processed_files = 0
+        self.current_file = ""
+        self.status_message = "Idle"
+        # An Event rather than a bool so waits in the uploader can wake on Stop
+        self.stop_event = threading.Event()
+
+    @property
+    def should_stop(self):
+        return self.stop_event.is_set()
+
+    @should_stop.setter
+    def should_stop(self, value):
+        if value:
+            self.stop_event.set()
+        else:
+            self.stop_event.clear()
+
+    def update(self, **fields):
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def increment_processed(self):
+        with self.lock:
+            self.processed_files += 1
+            return self.processed_files
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "is_running": self.is_running,
+                "total_files": self.total_files,
+                "processed_files": self.processed_files,
+                "current_file": self.current_file,
+                "status_message": self.status_message
+            }
 
 state = UploadState()
 
+# --- Upload Manifest ---
+_manifest_local = threading.local()
+_manifest_schema_lock = threading.Lock()
+
+def _init_manifest_schema(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        "abs_path TEXT PRIMARY KEY, size INTEGER, mtime REAL, doc_id TEXT, uploaded_at REAL, sha1 TEXT)"
+    )
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(uploads)")}
+    if 'sha1' not in columns:
+        # Manifests written before content hashing was added
+        conn.execute("ALTER TABLE uploads ADD COLUMN sha1 TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS uploads_sha1 ON uploads (sha1)")
+
+def _manifest_conn():
+    """Return this thread's connection to the manifest database."""
+    conn = getattr(_manifest_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(MANIFEST_DB)
+        # Idempotent, but workers connect concurrently and the sha1 ALTER must not race.
+        # Run per connection so a manifest deleted while the server runs is recreated.
+        with _manifest_schema_lock:
+            _init_manifest_schema(conn)
+        _manifest_local.conn = conn
+    return conn
+
+def manifest_lookup(abs_path, size, mtime):
+    row = _manifest_conn().execute(
+        "SELECT doc_id FROM uploads WHERE abs_path=? AND size=? AND mtime=?",
+        (abs_path, size, mtime)
+    ).fetchone()
+    return row[0] if row else None
+
+def manifest_lookup_hash(sha1):
+    row = _manifest_conn().execute(
+        "SELECT doc_id FROM uploads WHERE sha1=? LIMIT 1", (sha1,)
+    ).fetchone()
+    return row[0] if row else None
+
+def manifest_record(abs_path, size, mtime, doc_id, sha1):
+    conn = _manifest_conn()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO uploads (abs_path, size, mtime, doc_id, uploaded_at, sha1) VALUES (?, ?, ?, ?, ?, ?)",
+            (abs_path, size, mtime, doc_id, time.time(), sha1)
+        )
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+        # Python < 3.11
+        digest = hashlib.sha1()
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
+# Content hashes claimed by files in the running batch
+_batch_hashes = set()
+_batch_hashes_lock = threading.Lock()
+
+def claim_hash(sha1):
+    """Return True unless another file in this batch already has this content."""
+    with _batch_hashes_lock:
+        if sha1 in _batch_hashes:
+            return False
+        _batch_hashes.add(sha1)
+        return True
+
+def reset_batch_hashes():
+    with _batch_hashes_lock:
+        _batch_hashes.clear()
+
 # --- Application ---
-app = FastAPI()
+upload_queue = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global upload_queue
+    upload_queue = asyncio.Queue()
+    worker = asyncio.create_task(_worker_loop(upload_queue))
+    yield
+    # Let a running batch wind down so its last records still reach the log
+    state.update(should_stop=True)
+    upload_queue.put_nowait(None)
+    await worker
+    log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # Serve static files (Frontend)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # --- Helpers ---
-def get_access_token():
-    logger.info("Refreshing access token...")
-    payload = {
-        'grant_type': 'refresh_token',
-        'refresh_token': MENDELEY_REFRESH_TOKEN,
-        'client_id': MENDELEY_CLIENT_ID,
-        'client_secret': MENDELEY_CLIENT_SECRET,
-        'scope': 'all'
-    }
-    try:
-        response = requests.post(TOKEN_URL, data=payload, timeout=10)
-        if response.status_code == 200:
-            logger.info("Access token refreshed.")
-            return response.json()['access_token']
-        else:
-            logger.error(f"Failed to get token: {response.status_code} {response.text}")
-            raise Exception(f"Authentication Failed: {response.text}")
-    except Exception as e:
-        logger.error(f"Network error refreshing token: {str(e)}")
-        raise
-
-def create_document(access_token, title):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/vnd.mendeley-document.1+json'
-    }
-    data = {
-        'title': title,
-        'type': 'book'
-    }
-    try:
-        response = requests.post(DOCUMENTS_URL, headers=headers, json=data, timeout=30)
-        if response.status_code == 201:
-            doc_id = response.json()['id']
-            logger.info(f"Document created: id={doc_id}")
-            return doc_id
-        elif response.status_code == 429:
-            logger.warning("Rate limit (create doc). Waiting 5s...")
-            time.sleep(5)
-            # Recursion is dangerous if infinite, but simple here
-            return create_document(access_token, title)
-        else:
-            logger.error(f"Failed to create document '{title}': {response.status_code} - {response.text}")
-            return None
-    except Exception as e:
-        logger.error(f"Exception creating document '{title}': {str(e)}")
-        return None
-
-def upload_file_content(access_token, document_id, file_path):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/pdf',
-        'Link': f'<{DOCUMENTS_URL}/{document_id}>; rel="document"',
-        'Content-Disposition': f'attachment; filename="{os.path.basename(file_path)}"'
-    }
-    
+# Mendeley API client module, imported by the first process_upload_task
+uploader = None
+
+# Returned by _process_one for files it never started because Stop was pressed
+_STOPPED = object()
+
+def _process_one(file_path):
+    # Executor threads pick up queued files before the cancel loop reaches them
+    if state.should_stop:
+        return _STOPPED
+
+    filename = os.path.basename(file_path)
+    state.update(current_file=filename)
+    title = os.path.splitext(filename)[0].translate(_TITLE_TRANS)
+
+    abs_path = os.path.abspath(file_path)
+    stat = os.stat(abs_path)
+    if stat.st_size == 0:
+        logger.warning(f"SKIPPED (empty file): {filename}")
+        return
+    if stat.st_size > MAX_UPLOAD_BYTES:
+        logger.warning(f"SKIPPED (too large: {stat.st_size} bytes > {MAX_UPLOAD_BYTES}): {filename}")
+        return
+
+    uploaded_doc_id = manifest_lookup(abs_path, stat.st_size, stat.st_mtime)
+    if uploaded_doc_id:
+        logger.info(f"SKIPPED (already uploaded as {uploaded_doc_id}): {filename}")
+        return
+
+    # Same content under another path or name: reuse its document
+    sha1 = file_sha1(abs_path)
+    uploaded_doc_id = manifest_lookup_hash(sha1)
+    if uploaded_doc_id:
+        manifest_record(abs_path, stat.st_size, stat.st_mtime, uploaded_doc_id, sha1)
+        logger.info(f"SKIPPED (same content already uploaded as {uploaded_doc_id}): {filename}")
+        return
+    if not claim_hash(sha1):
+        logger.info(f"SKIPPED (duplicate of another file in this batch): {filename}")
+        return
+
+    logger.info(f"Processing: {filename}")
+
     try:
-        # Check file size for safety?
-        # If huge, might need streaming. Mendeley max is usually 50MB via API?
-        # For books > 50MB, simple POST might fail or timeout.
-        
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-            
-        response = requests.post(FILES_URL, headers=headers, data=file_content, timeout=120)
-        
-        if response.status_code == 201:
-            logger.info(f"File uploaded successfully for document {document_id}")
-            return True
-        elif response.status_code == 429:
-            logger.warning("Rate limit (upload file). Waiting 5s...")
-            time.sleep(5)
-            return upload_file_content(access_token, document_id, file_path)
+        # Create Doc
+        doc_id = uploader.create_document(title)
+        # Upload File
+        success = doc_id and uploader.upload_file_content(doc_id, file_path)
+    except uploader.UploadStopped:
+        logger.info(f"STOPPED while waiting to retry: {filename}")
+        return _STOPPED
+
+    if doc_id:
+        if success:
+            manifest_record(abs_path, stat.st_size, stat.st_mtime, doc_id, sha1)
+            logger.info(f"SUCCESS: {filename}")
         else:
-            logger.error(f"Failed to upload file content: {response.status_code} - {response.text}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Exception uploading file '{file_path}': {str(e)}")
-        return False
+            logger.error(f"FAILURE (upload): {filename}")
+    else:
+        logger.error(f"FAILURE (metadata): {filename}")
 
 def process_upload_task(path: str):
+    # Binds the module-level name that _process_one uses
+    global uploader
+    import uploader
+    uploader.stop_event = state.stop_event
+
     logger.info(f"Starting upload task for path: {path}")
-    state.is_running = True
-    state.should_stop = False
-    state.processed_files = 0
-    state.total_files = 0
+    # should_stop is reset by start_upload, so a stop sent while queued still applies
+    state.update(is_running=True, processed_files=0, total_files=0)
+    reset_batch_hashes()
+    if state.should_stop:
+        logger.info("Process stopped by user.", extra=FLUSH_LOG)
+        state.update(is_running=False, status_message="Stopped.")
+        return
     
     # 1. Access Token
     try:
-        access_token = get_access_token()
+        uploader.get_access_token()
     except Exception:
-        state.status_message = "Authentication Failed. Check Logs."
-        state.is_running = False
+        state.update(status_message="Authentication Failed. Check Logs.", is_running=False)
         return
 
     # 2. Collect Files
@@ -184,50 +319,60 @@ def process_upload_task(path: str):
         if path.lower().endswith('.pdf'):
             files_to_process.append(path)
     elif os.path.isdir(path):
-        files_to_process = glob.glob(os.path.join(path, "*.pdf"))
+        with os.scandir(path) as entries:
+            files_to_process = [
+                entry.path for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and entry.name.lower().endswith('.pdf')
+                and not entry.name.startswith('.')
+            ]
     
-    state.total_files = len(files_to_process)
-    logger.info(f"Found {state.total_files} PDF files to process.")
-    state.status_message = f"Processing directly from {path}"
-
-    # 3. Process Loop
-    for idx, file_path in enumerate(files_to_process):
-        if state.should_stop:
-            logger.info("Process stopped by user.")
-            state.status_message = "Stopped."
+    total_files = len(files_to_process)
+    state.update(total_files=total_files, status_message=f"Processing directly from {path}")
+    logger.info(f"Found {total_files} PDF files to process.")
+
+    # 3. Process Pool
+    stopped = False
+    with ThreadPoolExecutor(max_workers=uploader.UPLOAD_WORKERS) as executor:
+        futures = {executor.submit(_process_one, file_path): file_path for file_path in files_to_process}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            filename = os.path.basename(futures[future])
+            try:
+                outcome = future.result()
+            except Exception as e:
+                outcome = None
+                logger.error(f"CRITICAL ERROR on {filename}: {str(e)}")
+
+            if outcome is not _STOPPED:
+                processed = state.increment_processed()
+                logger.info(f"[{processed}/{total_files}] Done: {filename}")
+
+            if state.should_stop and not stopped:
+                stopped = True
+                logger.info("Process stopped by user.")
+                for pending in futures:
+                    pending.cancel()
+
+    state.update(is_running=False, current_file="", status_message="Stopped." if stopped else "Completed")
+    logger.info("Batch processing finished.", extra=FLUSH_LOG)
+
+
+async def _worker_loop(paths):
+    """Run queued upload batches one at a time, off the event loop, until given None."""
+    while True:
+        path = await paths.get()
+        if path is None:
             break
-            
-        filename = os.path.basename(file_path)
-        state.current_file = filename
-        title = os.path.splitext(filename)[0].replace('_', ' ')
-        
-        logger.info(f"[{idx+1}/{state.total_files}] Processing: {filename}")
-        
         try:
-            # Create Doc
-            doc_id = create_document(access_token, title)
-            if doc_id:
-                # Upload File
-                success = upload_file_content(access_token, doc_id, file_path)
-                if success:
-                    logger.info(f"SUCCESS: {filename}")
-                else:
-                    logger.error(f"FAILURE (upload): {filename}")
-            else:
-                 logger.error(f"FAILURE (metadata): {filename}")
-                 
+            await asyncio.to_thread(process_upload_task, path)
         except Exception as e:
-            logger.error(f"CRITICAL ERROR on {filename}: {str(e)}")
-
-        state.processed_files += 1
-        
-        # Polite delay
-        time.sleep(1.0)
-    
-    state.is_running = False
-    state.current_file = ""
-    state.status_message = "Completed"
-    logger.info("Batch processing finished.")
+            logger.error(f"Upload task for {path} failed: {str(e)}")
+            state.update(is_running=False, current_file="", status_message="Failed. Check Logs.")
+        finally:
+            paths.task_done()
 
 
 # --- API Models ---
@@ -235,38 +380,40 @@ class UploadRequest(BaseModel):
     path: str
 
 # --- API Endpoints ---
+# Endpoints that never block run directly on the event loop; the upload
+# batch itself runs off-loop on the worker thread pool.
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Mendeley Upload Server Running. Go to /static/index.html"}
 
 @app.post("/api/start-upload")
-async def start_upload(request: UploadRequest, background_tasks: BackgroundTasks):
-    if state.is_running:
-        raise HTTPException(status_code=400, detail="Job already running.")
-    
+async def start_upload(request: UploadRequest):
     if not os.path.exists(request.path):
          raise HTTPException(status_code=404, detail="Path not found.")
-         
-    background_tasks.add_task(process_upload_task, request.path)
+
+    # Claim the running flag here so two quick requests can't both queue a batch
+    with state.lock:
+        if state.is_running:
+            raise HTTPException(status_code=400, detail="Job already running.")
+        state.is_running = True
+        state.should_stop = False
+        state.status_message = "Queued"
+
+    upload_queue.put_nowait(request.path)
     return {"message": "Upload started", "path": request.path}
 
 @app.post("/api/stop")
-def stop_upload():
-    if state.is_running:
-        state.should_stop = True
-        return {"message": "Stopping..."}
+async def stop_upload():
+    with state.lock:
+        if state.is_running:
+            state.should_stop = True
+            return {"message": "Stopping..."}
     return {"message": "Not running"}
 
 @app.get("/api/status")
-def get_status():
-    return {
-        "is_running": state.is_running,
-        "total_files": state.total_files,
-        "processed_files": state.processed_files,
-        "current_file": state.current_file,
-        "status_message": state.status_message
-    }
+async def get_status():
+    return state.snapshot()
 
 @app.get("/api/logs")
-def get_logs():
-    return {"logs": memory_handler.logs}
+async def get_logs():
+    return {"logs": list(memory_handler.logs)}
@@ -0,0 +1,343 @@
+"""Mendeley API client used by the upload worker.
+
+Imported lazily from main.process_upload_task so that starting the server
+doesn't pay for loading requests/urllib3 until the first upload.
+"""
+import os
+import time
+import logging
+import threading
+import random
+import requests
+import orjson
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from typing import Optional
+from dotenv import load_dotenv
+
+# --- Configuration ---
+load_dotenv()
+
+MENDELEY_CLIENT_ID = os.getenv("MENDELEY_CLIENT_ID")
+MENDELEY_CLIENT_SECRET = os.getenv("MENDELEY_CLIENT_SECRET")
+MENDELEY_REFRESH_TOKEN = os.getenv("MENDELEY_REFRESH_TOKEN")
+
+# Number of files created/uploaded concurrently
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+
+# Client-side cap used only when the API sends no X-RateLimit-* headers (0 = off)
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "0"))
+
+TOKEN_URL = "https://api.mendeley.com/oauth/token"
+DOCUMENTS_URL = "https://api.mendeley.com/documents"
+FILES_URL = "https://api.mendeley.com/files"
+
+# Bytes read from disk and handed to the TLS socket per write when streaming a file
+UPLOAD_BLOCKSIZE = 1024 * 1024
+
+logger = logging.getLogger("mendeley_uploader")
+
+# Set when the user stops the batch or the server shuts down; main binds this
+# to UploadState's event so rate-limit and backoff pauses end early.
+stop_event = threading.Event()
+
+class UploadStopped(Exception):
+    """Raised from a pause that was cut short by `stop_event`."""
+
+def _pause(delay):
+    if stop_event.wait(delay):
+        raise UploadStopped("Upload stopped")
+
+# --- HTTP Session ---
+class _BlockSizeAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections stream request bodies in UPLOAD_BLOCKSIZE blocks."""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['blocksize'] = UPLOAD_BLOCKSIZE
+        super().init_poolmanager(*args, **kwargs)
+
+# One pooled session so token refresh, document creation and file upload
+# reuse keep-alive connections instead of a new TLS handshake per call. Each
+# upload worker keeps its own connection alive, so one worker's document
+# create overlaps another's upload without waiting on or reopening a socket.
+SESSION = requests.Session()
+SESSION.mount('https://', _BlockSizeAdapter(pool_connections=4, pool_maxsize=max(8, UPLOAD_WORKERS), max_retries=0))
+
+# --- Token Cache ---
+class TokenCache:
+    """Current access token and its expiry, shared by all workers."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+
+    def invalidate(self, token):
+        # Only drop the token that was rejected, not one another worker just fetched
+        with self.lock:
+            if self.token == token:
+                self.token = None
+                self.expires_at = 0.0
+
+token_cache = TokenCache()
+
+# --- Rate Limiting ---
+class AdaptiveLimiter:
+    """AIMD concurrency limit shared by all upload workers.
+
+    Halves the number of requests allowed in flight on every throttle
+    response and adds one back after each `window` consecutive successes.
+    """
+    def __init__(self, max_limit, window=10):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.window = window
+        self.in_flight = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def on_throttle(self):
+        with self.cond:
+            self.successes = 0
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                logger.warning(f"Throttled: concurrency reduced to {self.limit}")
+
+    def on_success(self):
+        with self.cond:
+            self.successes += 1
+            if self.successes >= self.window and self.limit < self.max_limit:
+                self.successes = 0
+                self.limit += 1
+                self.cond.notify_all()
+
+limiter = AdaptiveLimiter(UPLOAD_WORKERS)
+
+@dataclass
+class RateLimitState:
+    """Tracks the server's X-RateLimit-* headers so requests pause before a 429."""
+    threshold: int = 2
+    per_minute: int = 0
+    remaining: Optional[int] = None
+    reset_at: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    recent: deque = field(default_factory=deque)
+
+    def update_from_headers(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        with self.lock:
+            if remaining is not None:
+                try:
+                    self.remaining = int(remaining)
+                except ValueError:
+                    pass
+            if reset is not None:
+                try:
+                    reset = float(reset)
+                except ValueError:
+                    return
+                # Either an epoch timestamp or seconds until reset
+                self.reset_at = reset if reset > 1e9 else time.time() + reset
+
+    def wait_if_throttled(self):
+        with self.lock:
+            now = time.time()
+            delay = 0.0
+            if self.remaining is not None:
+                if self.remaining <= self.threshold and self.reset_at > now:
+                    delay = self.reset_at - now
+            elif self.per_minute:
+                # No headers seen: fall back to a sliding one-minute window.
+                # `recent` holds scheduled send times, so queued callers each
+                # wait a minute past the slot they displace, not the oldest one.
+                while self.recent and now - self.recent[0] >= 60:
+                    self.recent.popleft()
+                if len(self.recent) >= self.per_minute:
+                    delay = max(0.0, self.recent[-self.per_minute] + 60 - now)
+                self.recent.append(now + delay)
+        if delay > 0:
+            logger.info(f"Approaching rate limit. Pausing {delay:.1f}s...")
+            _pause(delay)
+
+rate_limit = RateLimitState(per_minute=RATE_LIMIT_PER_MINUTE)
+
+# --- API Calls ---
+RETRY_STATUSES = (429, 503)
+
+def _parse_retry_after(value):
+    """Return the Retry-After delay in seconds (delta-seconds or HTTP-date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _nothing_sent(error):
+    """True if a ConnectionError happened before any of the request reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def _request_with_retry(method, url, *, max_retries=5, base=1.0, cap=30.0, **kwargs):
+    """Issue a request, retrying 429/503 with Retry-After or jittered exponential backoff.
+
+    Failures to connect are retried with the same backoff. Errors after the
+    request went out are not, since the server may already have acted on it.
+    """
+    # File bodies are consumed by each attempt; rewind them before a retry
+    body = kwargs.get('data')
+    start = body.tell() if hasattr(body, 'seek') else None
+    reauthenticated = False
+    for attempt in range(max_retries):
+        last_attempt = attempt == max_retries - 1
+        backoff = min(cap, base * 2 ** attempt) * (1 + random.uniform(0, 0.5))
+        if start is not None:
+            body.seek(start)
+        access_token = get_access_token()
+        rate_limit.wait_if_throttled()
+        limiter.acquire()
+        try:
+            response = SESSION.request(method, url, **kwargs)
+        except requests.ConnectionError as e:
+            if not _nothing_sent(e) or last_attempt:
+                raise
+            error = e
+        else:
+            error = None
+        finally:
+            limiter.release()
+
+        if error is not None:
+            logger.warning(f"Could not connect for {method} {url}: {error}. Retrying in {backoff:.1f}s...")
+            _pause(backoff)
+            continue
+        rate_limit.update_from_headers(response.headers)
+
+        if response.status_code == 401 and not reauthenticated and not last_attempt:
+            reauthenticated = True
+            logger.warning(f"Access token rejected on {method} {url}. Refreshing and retrying...")
+            token_cache.invalidate(access_token)
+            continue
+
+        if response.status_code not in RETRY_STATUSES:
+            # Only real successes count towards raising concurrency again
+            if 200 <= response.status_code < 300:
+                limiter.on_success()
+            return response
+
+        limiter.on_throttle()
+        if last_attempt:
+            break
+        delay = _parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = backoff
+        logger.warning(f"Rate limited ({response.status_code}) on {method} {url}. Retrying in {delay:.1f}s...")
+        _pause(delay)
+    return response
+
+def get_access_token():
+    """Return a valid access token, refreshing it only when missing or about to expire."""
+    with token_cache.lock:
+        if token_cache.token and time.time() < token_cache.expires_at - 60:
+            return token_cache.token
+
+        access_token, expires_in = _refresh_access_token()
+        token_cache.token = access_token
+        token_cache.expires_at = time.time() + expires_in
+        SESSION.headers['Authorization'] = f'Bearer {access_token}'
+        return access_token
+
+def _refresh_access_token():
+    logger.info("Refreshing access token...")
+    payload = {
+        'grant_type': 'refresh_token',
+        'refresh_token': MENDELEY_REFRESH_TOKEN,
+        'client_id': MENDELEY_CLIENT_ID,
+        'client_secret': MENDELEY_CLIENT_SECRET,
+        'scope': 'all'
+    }
+    try:
+        # Don't send a stale bearer token to the token endpoint
+        response = SESSION.post(TOKEN_URL, data=payload, headers={'Authorization': None}, timeout=10)
+        if response.status_code == 200:
+            logger.info("Access token refreshed.")
+            token = orjson.loads(response.content)
+            return token['access_token'], float(token.get('expires_in', 3600))
+        else:
+            logger.error(f"Failed to get token: {response.status_code} {response.text}")
+            raise Exception(f"Authentication Failed: {response.text}")
+    except Exception as e:
+        logger.error(f"Network error refreshing token: {str(e)}")
+        raise
+
+# Authorization comes from the session, so these never change between documents
+DOCUMENT_HEADERS = {
+    'Content-Type': 'application/vnd.mendeley-document.1+json'
+}
+
+def create_document(title):
+    data = orjson.dumps({'title': title, 'type': 'book'})
+    try:
+        response = _request_with_retry('POST', DOCUMENTS_URL, headers=DOCUMENT_HEADERS, data=data, timeout=30)
+        if response.status_code == 201:
+            doc_id = orjson.loads(response.content)['id']
+            logger.info(f"Document created: id={doc_id}")
+            return doc_id
+        else:
+            logger.error(f"Failed to create document '{title}': {response.status_code} - {response.text}")
+            return None
+    except UploadStopped:
+        raise
+    except Exception as e:
+        logger.error(f"Exception creating document '{title}': {str(e)}")
+        return None
+
+def upload_file_content(document_id, file_path):
+    size = os.path.getsize(file_path)
+    headers = {
+        'Content-Type': 'application/pdf',
+        'Content-Length': str(size),
+        'Link': f'<{DOCUMENTS_URL}/{document_id}>; rel="document"',
+        'Content-Disposition': f'attachment; filename="{os.path.basename(file_path)}"'
+    }
+    
+    try:
+        # Stream the file from disk rather than buffering the whole PDF in memory
+        with open(file_path, 'rb') as f:
+            response = _request_with_retry('POST', FILES_URL, headers=headers, data=f, timeout=120)
+        
+        if response.status_code == 201:
+            logger.info(f"File uploaded successfully for document {document_id}")
+            return True
+        else:
+            logger.error(f"Failed to upload file content: {response.status_code} - {response.text}")
+            return False
+            
+    except UploadStopped:
+        raise
+    except Exception as e:
+        logger.error(f"Exception uploading file '{file_path}': {str(e)}")
+        return False